@@ -5,42 +5,113 @@ Description:
 
 Usage:
     
-    parque.py <path> [--inc=*.parquet] [--details=n] [--pool=8] [--log=DEBUG] [--recurse] [--help]
+    parque.py <path> [--inc=*.parquet] [--details=n] [--pool=8] [--log=DEBUG] [--recurse] [--no-cache] [--procs] [--obstore] [--mmap] [--lines] [--dedup] [--check] [--use-metadata-sidecar | --no-metadata-sidecar] [--help]
 
 Options:
     -h --help      Show this screen
     --inc=PATTERN  Find files matching the glob patterns [default: *.parquet]
+                   patterns with / match one directory level per part, ** matches any depth
     --recurse      Recursively find files matching <glob> starting from <path>
+                   ignored for patterns with /, which say how deep to look themselves
     --details=n    Print extra details 0,1,2 [default: 1]
-    --pool=<n>     Spin up n processes to process in parallel [default: 8]. 
+    --pool=<n>     Spin up n workers to process in parallel, 8 if not given
+    --procs        Use worker processes instead of threads, helps CPU bound --details=2
+    --obstore      Fetch footers with many concurrent async requests through obstore
+    --mmap         Memory map local files instead of reading them
     --log=<lvl>    Log level: choices=("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL") [default: ERROR]
+    --no-cache     Do not read or update the metadata cache in ~/.cache/parqu
+    --lines        Print one JSON object per file per line instead of a JSON array
+    --dedup        With --details=1 print each distinct schema once, files refer to it by id
+    --check        Only check each file can be read, print status|path|size lines
+    --use-metadata-sidecar  Take the metadata of the files listed in <path>/_metadata from it
+                            instead of opening them, the row groups give each file's share
+    --no-metadata-sidecar   Open every file even when there is a _metadata sidecar, the default
 
 """
 
 import multiprocessing
+import pyarrow as pa
 from pyarrow import fs as FS
 import pyarrow.parquet as pq
 from pyarrow.lib import ArrowInvalid
 from logzero import logger
 import json
 import fnmatch
+import gc
+import asyncio
+import hashlib
+import re
+import sqlite3
+import struct
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from itertools import chain, islice
 from multiprocessing import Pool
+from operator import attrgetter, methodcaller
+from pathlib import Path
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:  # optional, falls back to the much slower stdlib json
+    orjson = None
+
+try:
+    import obstore
+    from obstore.exceptions import BaseError as StoreError
+    from obstore.store import GCSStore, LocalStore, S3Store
+except ImportError:  # optional, only needed for --obstore
+    obstore = None
 
 
 # https://parquet.apache.org/documentation/latest/
 
+CACHE_DIR = Path.home() / ".cache" / "parqu"
+# part of every cache key, bump it when the shape of the results changes
+CACHE_VERSION = 2
+# results written to the cache per transaction, other runs wait at most one batch
+CACHE_BATCH = 256
+# bytes fetched from the end of each file, enough for the footer of all but very wide files
+FOOTER_PREFETCH = 256 * 1024
+# header magic + footer length + footer magic, anything smaller is not worth opening
+MIN_SIZE = 12
+# concurrent footer requests with --obstore, one CPU keeps this many busy
+MAX_INFLIGHT = 256
+# file system of --procs worker processes, set by _init_worker (or inherited on fork)
+_FS = None
+
+
+@dataclass
+class Result:
+    """Outcome of reading the metadata of one file"""
+
+    # slots need no per-instance __dict__, results are created for every file
+    __slots__ = ("status", "file_name", "file_size", "meta_data")
+    status: str
+    file_name: str
+    file_size: int
+    meta_data: Optional[dict]
+
+    def as_dict(self) -> dict:
+        return {f: getattr(self, f) for f in self.__slots__}
+
+
+_column_attrs = attrgetter("name", "physical_type", "logical_type")
+
 
 def simple_schema(file_meta: pq.FileMetaData) -> dict:
     """Returns the simple schema for given parquet file"""
 
-    columns = [
-        {
-            "field_name": c.name,
-            "physical_type": str(c.physical_type),
-            "logical_type": str(c.logical_type),
-        }
-        for c in file_meta.schema
-    ]
+    # one list per attribute rather than a dict per column, keys aren't repeated per column
+    # a single pass over the schema, attrgetter fetches the three attributes in C
+    rows = map(_column_attrs, file_meta.schema)
+    names, physical, logical = zip(*rows) if file_meta.num_columns else ((), (), ())
+    columns = {
+        "field_name": list(names),
+        "physical_type": list(map(str, physical)),
+        "logical_type": list(map(str, logical)),
+    }
 
     result = {
         "format_version": file_meta.format_version,
@@ -53,57 +124,310 @@ def simple_schema(file_meta: pq.FileMetaData) -> dict:
     return result
 
 
-def get_metadata(FS: pq.FileSystem, path: str, details: int) -> dict:
+def to_json(data, indent=False) -> bytes:
+    """Serializes data to JSON with sorted keys, using orjson when it is installed"""
+    if orjson:
+        # OPT_SORT_KEYS does not reorder dataclass fields, hand Result over as a dict
+        option = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS
+        option |= orjson.OPT_INDENT_2 if indent else 0
+        return orjson.dumps(data, default=Result.as_dict, option=option)
+    # raw utf-8 like orjson, so output and cache don't depend on what is installed
+    options = {"sort_keys": True, "ensure_ascii": False, "default": Result.as_dict}
+    if indent:
+        text = json.dumps(data, indent=2, **options)
+    else:
+        text = json.dumps(data, separators=(",", ":"), **options)
+    return text.encode()
+
+
+def footer_length(tail: pa.Buffer) -> int:
+    """Returns how many bytes at the end of a parquet file hold its footer, 0 if unknown"""
+    # the file ends with <footer><4 byte footer length><PAR1>
+    # without the magic the length is garbage, don't let it size another read
+    if len(tail) < 8 or bytes(tail[-4:]) != b"PAR1":
+        return 0
+    return struct.unpack("<I", tail[-8:-4])[0] + 8
+
+
+def footer_start(tail: pa.Buffer, size: int) -> Optional[int]:
+    """Returns where to read the footer from if tail, the end of the file, holds only part of it"""
+    needed = footer_length(tail)
+    if len(tail) < needed <= size:
+        return size - needed
+    # all there, or not parquet and parse_footer will say so
+    return None
+
+
+def parse_footer(tail: pa.Buffer) -> pq.FileMetaData:
+    """Returns the metadata held in tail, the end of a parquet file"""
+    return pq.read_metadata(pa.BufferReader(tail))
+
+
+def read_footer(f: pa.NativeFile, size: int) -> pq.FileMetaData:
+    """Returns the metadata of an open parquet file, reading its tail in a single request"""
+    tail = f.read_at(min(size, FOOTER_PREFETCH), max(0, size - FOOTER_PREFETCH))
+    start = footer_start(tail, size)
+    if start is not None:
+        tail = f.read_at(size - start, start)
+    return parse_footer(tail)
+
+
+def add_metadata(result: Result, file_meta: pq.FileMetaData, details: int) -> Result:
+    """Adds the metadata to result at the given level of details and marks it OK"""
+    if details == 0:
+        # checks the file - dont care to process
+        pass
+    elif details == 1:
+        result.meta_data = simple_schema(file_meta)
+    elif details == 2:
+        result.meta_data = byte_me(file_meta.to_dict())
+    else:
+        logger.error("Unknown option for details")
+        # raise (ValueError)
+    # if we haven't got an exeception, set status to be OK
+    result.status = "OK"
+    return result
+
+
+def too_small(path: str, size: int) -> Result:
+    """Returns the error result for a file too small to be parquet"""
+    logger.error(f"Cannot process [{path}] - too small to be parquet")
+    return Result("Error: too small", path, size, None)
+
+
+def get_metadata(
+    FS: pq.FileSystem, path: str, size: int, details: int, mmap=False
+) -> Result:
     """Returns the schema of parquet file
 
+    size comes from the directory listing so the file is not stat'ed a second time
     If details is 0 it will return the extensive/exhaustive details
+    mmap memory maps the (local) file so the footer is served from the page cache
     """
 
-    result = {"status": "Error", "file_name": path, "file_size": 0}
-    with FS.open_input_file(path) as f:
-        logger.debug(f"Opening {path}")
-        try:
-            result["file_size"] = f.size()
-            # set the size
-            if details == 0:
-                # checks the file - dont care to process
-                _ = pq.ParquetFile(f).metadata
-            elif details == 1:
-                result["meta_data"] = simple_schema(pq.ParquetFile(f).metadata)
-            elif details == 2:
-                result["meta_data"] = byte_me(pq.ParquetFile(f).metadata.to_dict())
-            else:
-                logger.error("Unknown option for details")
-                # raise (ValueError)
-            # if we haven't got an exeception, set status to be OK
-            result["status"] = "OK"
-        except ArrowInvalid as e:
-            logger.error(f"Cannot process [{path}] - invalid format?")
-            # logger.exception(e)
+    if size is not None and size < MIN_SIZE:
+        return too_small(path, size)
+    result = Result("Error", path, size or 0, None)
+    try:
+        with pa.memory_map(path, "r") if mmap else FS.open_input_file(path) as f:
+            logger.debug(f"Opening {path}")
+            if size is None:
+                result.file_size = f.size()
+            add_metadata(result, read_footer(f, result.file_size), details)
+    except ArrowInvalid as e:
+        logger.error(f"Cannot process [{path}] - invalid format?")
+        # logger.exception(e)
+    except OSError as e:
+        # e.g. removed since it was listed, report it rather than abort the whole run
+        logger.error(f"Cannot read [{path}] - {e}")
     return result
 
 
+def parse_tail(result: Result, tail: pa.Buffer, details: int) -> Result:
+    """Adds the metadata held in tail, the end of the file, to result"""
+    try:
+        add_metadata(result, parse_footer(tail), details)
+    except ArrowInvalid as e:
+        logger.error(f"Cannot process [{result.file_name}] - invalid format?")
+    return result
+
+
+async def get_metadata_async(store, key: str, path: str, size: int, details: int):
+    """Returns the schema of parquet file like get_metadata, fetching it through obstore"""
+    result = Result("Error", path, size or 0, None)
+    try:
+        if size is None:
+            size = result.file_size = (await obstore.head_async(store, key))["size"]
+        if size < MIN_SIZE:
+            return too_small(path, size)
+
+        logger.debug(f"Fetching {path}")
+        start = max(0, size - FOOTER_PREFETCH)
+        tail = pa.py_buffer(
+            await obstore.get_range_async(store, key, start=start, end=size)
+        )
+        start = footer_start(tail, size)
+        if start is not None:
+            tail = pa.py_buffer(
+                await obstore.get_range_async(store, key, start=start, end=size)
+            )
+    except (OSError, StoreError) as e:
+        logger.error(f"Cannot read [{path}] - {e}")
+        return result
+    # parsing holds the GIL, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, parse_tail, result, tail, details)
+
+
 def byte_me(data, hex=True):
-    """recursively convert bytes into either hex or utf-8 strings"""
+    """convert bytes into either hex or utf-8 strings, and everything else into strings"""
     # some parquet files have bytes in schema/descriptions
     # some metadata statistics contain bytes - # conver to hex for easier reading
-    if isinstance(data, dict):
-        return dict([byte_me(d, hex) for d in data.items()])
-    if isinstance(data, bytes):
-        return data.hex() if hex else data.decode("utf-8")
-    if isinstance(data, tuple):
-        return [byte_me(d, hex) for d in data]
-    if isinstance(data, list):
-        return [byte_me(d, hex) for d in data]
-    return str(data)
-
-
-def get_filelist(input_path: str, pattern="*.parquet", recurse=False):
-    """Returns a FileSystem object and a list of FileInfo objects that matches the pattern"""
+    to_text = bytes.hex if hex else lambda b: b.decode("utf-8")
+    containers = (dict, list, tuple)
+
+    # walk with an explicit stack rather than recursing, wide files have thousands
+    # of column chunks; leaves are converted inline and only containers are pushed
+    root = [None]
+    stack = [(root, 0, data)]
+    while stack:
+        parent, key, node = stack.pop()
+        if isinstance(node, dict):
+            new = parent[key] = {}
+            for k, v in node.items():
+                if type(k) is not str:
+                    k = to_text(k) if isinstance(k, bytes) else str(k)
+                if isinstance(v, containers):
+                    new[k] = None
+                    stack.append((new, k, v))
+                else:
+                    new[k] = to_text(v) if isinstance(v, bytes) else str(v)
+        elif isinstance(node, (list, tuple)):
+            new = parent[key] = [None] * len(node)
+            for i, v in enumerate(node):
+                if isinstance(v, containers):
+                    stack.append((new, i, v))
+                else:
+                    new[i] = to_text(v) if isinstance(v, bytes) else str(v)
+        else:
+            parent[key] = to_text(node) if isinstance(node, bytes) else str(node)
+    return root[0]
+
+
+def name_matcher(pattern: str):
+    """Returns a function that checks a file name against a glob pattern"""
+    suffix = pattern[1:]
+    if pattern.startswith("*") and not any(c in suffix for c in "*?["):
+        # the common *.parquet case is a plain suffix compare
+        return methodcaller("endswith", suffix)
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+def _match_parts(matchers: list, parts: list) -> bool:
+    """Checks the parts of a relative path against per-part matchers, None being **"""
+    if not matchers:
+        return not parts
+    if matchers[0] is None:
+        return any(_match_parts(matchers[1:], parts[i:]) for i in range(len(parts) + 1))
+    return bool(parts and matchers[0](parts[0])) and _match_parts(
+        matchers[1:], parts[1:]
+    )
+
+
+def glob_files(fs: FS.FileSystem, root: str, pattern: str) -> list:
+    """Returns FileInfo objects under root that match a path pattern like year=*/**/*.parquet
+
+    Directories are listed one level at a time, so subtrees that cannot match are never listed,
+    unless the pattern starts with ** (or */**) which needs a single recursive listing instead
+    """
+    segments = pattern.strip("/").split("/")
+    if segments[-1] == "**":
+        segments.append("*")
+    # None stands for **, which matches zero or more directories
+    matchers = [None if s == "**" else name_matcher(s) for s in segments]
+
+    if None in matchers and all(s == "*" for s in segments[: matchers.index(None)]):
+        # nothing before the first ** can rule a directory out, so one recursive
+        # listing is cheaper than one listing per directory
+        listing = fs.get_file_info(FS.FileSelector(root, recursive=True))
+        skip = len(root.rstrip("/")) + 1
+        return [
+            f
+            for f in listing
+            if f.type == FS.FileType.File
+            and _match_parts(matchers, f.path[skip:].split("/"))
+        ]
+
+    listings = {}
+    found = {}
+    seen = set()
+    pending = [(root, 0)]
+    while pending:
+        state = pending.pop()
+        if state in seen:
+            continue
+        seen.add(state)
+        cur, i = state
+        if cur not in listings:
+            listings[cur] = fs.get_file_info(FS.FileSelector(cur, recursive=False))
+
+        last = i == len(segments) - 1
+        for f in listings[cur]:
+            if matchers[i] is None:
+                if f.type == FS.FileType.Directory:
+                    pending.append((f.path, i))
+            elif matchers[i](f.base_name):
+                if last and f.type == FS.FileType.File:
+                    found[f.path] = f
+                elif not last and f.type == FS.FileType.Directory:
+                    pending.append((f.path, i + 1))
+        if matchers[i] is None:
+            pending.append((cur, i + 1))
+    return list(found.values())
+
+
+def sidecar_results(fs, root: str, fileinfo: list, details: int):
+    """Returns results for the files described by the _metadata sidecar in root and the files left
+
+    Files missing from the sidecar or changed after it was written are left to be read
+    """
+    meta = fs.get_file_info(f"{root}/_metadata")
+    if meta.type != FS.FileType.File:
+        return [], fileinfo
+    try:
+        with fs.open_input_file(meta.path) as f:
+            file_meta = read_footer(f, meta.size)
+    except (ArrowInvalid, OSError) as e:
+        logger.error(f"Cannot process [{meta.path}] - ignoring the sidecar: {e}")
+        return [], fileinfo
+    logger.info(f"Using {meta.path} for {file_meta.num_row_groups} row groups")
+
+    # the sidecar holds the row groups of every file, each column says which file
+    groups, num_rows = {}, []
+    for i in range(file_meta.num_row_groups):
+        row_group = file_meta.row_group(i)
+        num_rows.append(row_group.num_rows)
+        if row_group.num_columns:
+            groups.setdefault(row_group.column(0).file_path, []).append(i)
+
+    shared = None
+    if details == 1:
+        shared = simple_schema(file_meta)
+    elif details == 2:
+        shared = file_meta.to_dict()
+
+    results, rest = [], []
+    for info in fileinfo:
+        found = groups.get(info.path[len(root) :].lstrip("/"))
+        if not found or (info.mtime_ns or 0) > (meta.mtime_ns or 0):
+            rest.append(info)
+            continue
+        result = Result("OK", info.path, info.size, None)
+        if shared is not None:
+            rows = sum(num_rows[i] for i in found)
+            result.meta_data = dict(shared, num_rows=rows, num_row_groups=len(found))
+        if details == 2:
+            result.meta_data["row_groups"] = [shared["row_groups"][i] for i in found]
+            result.meta_data = byte_me(result.meta_data)
+        results.append(result)
+    logger.debug(f"Found {len(results)} of {len(fileinfo)} objects in the sidecar")
+    return results, rest
+
+
+def get_filelist(
+    input_path: str, pattern="*.parquet", recurse=False, details=1, sidecar=False
+):
+    """Returns a FileSystem object, a list of FileInfo objects that match the pattern
+    and a list of the results known without opening the files
+
+    These are the files too small to be parquet and, with sidecar, the files
+    described by the _metadata file in the directory
+    """
     fs, path = FS.FileSystem.from_uri(input_path)
 
     # pretend path is an array makes the logic for single file easier
     fileinfo = fs.get_file_info([path])
+    root = fileinfo[0]
     if (
         fileinfo[0].type == FS.FileType.NotFound
         or fileinfo[0].type == FS.FileType.Unknown
@@ -114,30 +438,370 @@ def get_filelist(input_path: str, pattern="*.parquet", recurse=False):
     if fileinfo[0].type == FS.FileType.File:
         logger.info(f"Checking a single file: {fileinfo[0].path}")
         pass
+    elif fileinfo[0].type == FS.FileType.Directory and (
+        "/" in pattern or pattern == "**"
+    ):
+        # a bare ** is a path pattern too, any file at any depth
+        if recurse:
+            logger.warning("--recurse is ignored for path patterns, use ** instead")
+        fileinfo = glob_files(fs, path, pattern)
     elif fileinfo[0].type == FS.FileType.Directory:
         fileinfo = fs.get_file_info(FS.FileSelector(path, recursive=recurse))
-        fileinfo = [f for f in fileinfo if fnmatch.fnmatch(f.base_name, pattern)]
+        matches = name_matcher(pattern)
+        fileinfo = [f for f in fileinfo if matches(f.base_name)]
 
     logger.debug(
         f"Finished collecting {len(fileinfo)} objects from {fs.type_name} file system"
     )
-    return fs, fileinfo
+    done = []
+    if sidecar and root.type == FS.FileType.Directory:
+        done, fileinfo = sidecar_results(fs, path, fileinfo, details)
+    small = [f for f in fileinfo if f.size is not None and f.size < MIN_SIZE]
+    if small:
+        fileinfo = [f for f in fileinfo if f.size is None or f.size >= MIN_SIZE]
+        done += [too_small(f.path, f.size) for f in small]
+    return fs, fileinfo, done
+
+
+def cache_stamp(info: FS.FileInfo):
+    """Returns what a cached result must match to be current, or None if there is no mtime"""
+    # size + mtime identify a version of the file, CACHE_VERSION the shape of the result
+    if info.mtime_ns is None:
+        return None
+    return (info.size or 0, info.mtime_ns, CACHE_VERSION)
+
+
+def open_cache():
+    """Returns a connection to the on-disk metadata cache, or None if it is unusable"""
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(str(CACHE_DIR / "metadata.db"))
+        # readers of concurrent runs are not blocked while this one writes
+        db.execute("PRAGMA journal_mode=WAL")
+        # one row per file and details, a rewritten file replaces its stale row
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS results(path TEXT, details INTEGER, size INTEGER,"
+            " mtime INTEGER, version INTEGER, v TEXT, PRIMARY KEY (path, details))"
+        )
+        # rows of the old table were keyed on a hash of the version, never replaced
+        db.execute("DROP TABLE IF EXISTS c")
+        return db
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Metadata cache disabled: {e}")
+        return None
+
+
+def _batches(db: sqlite3.Connection, columns: str, paths: list, details: int):
+    """Yields the rows of the given columns for the cached paths, a few hundred per query"""
+    # stay well under sqlite's limit on the number of bound parameters
+    for i in range(0, len(paths), 500):
+        batch = paths[i : i + 500]
+        marks = ",".join("?" * len(batch))
+        query = f"SELECT {columns} FROM results WHERE details = ? AND path IN ({marks})"
+        yield from db.execute(query, [details, *batch])
+
+
+def cache_get(db: sqlite3.Connection, stamps: dict, details: int) -> set:
+    """Returns the paths of the files whose cached result is still current"""
+    # only the stamps up front, the results are streamed by cache_hits
+    paths = [p for p, stamp in stamps.items() if stamp is not None]
+    found = set()
+    try:
+        for path, *stamp in _batches(db, "path, size, mtime, version", paths, details):
+            if tuple(stamp) == stamps[path]:
+                found.add(path)
+    except sqlite3.Error as e:
+        logger.warning(f"Metadata cache not read: {e}")
+        found.clear()
+    return found
+
+
+def cache_hits(db: sqlite3.Connection, found: set, details: int, sizes: dict):
+    """Yields the cached results for the paths cache_get found"""
+    done = set()
+    try:
+        for path, v in _batches(db, "path, v", list(found), details):
+            done.add(path)
+            yield Result(**json.loads(v))
+    except sqlite3.Error as e:
+        logger.error(f"Metadata cache read failed: {e}")
+    # don't lose files whose result went missing from under us
+    for path in found - done:
+        logger.error(f"Cannot process [{path}] - cached result unavailable")
+        yield Result("Error", path, sizes[path], None)
+
+
+def cache_put(db: sqlite3.Connection, rows: list) -> bool:
+    """Stores rows in the cache in one short transaction, returns False if that failed"""
+    try:
+        with db:
+            db.executemany("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?)", rows)
+        return True
+    except sqlite3.Error as e:
+        logger.warning(f"Metadata cache disabled: {e}")
+        return False
+
+
+def cache_through(db: sqlite3.Connection, results, stamps: dict, details: int):
+    """Yields results unchanged, storing the successful ones in the cache on the way"""
+    rows = []
+    for r in results:
+        stamp = stamps.get(r.file_name)
+        if db and stamp is not None and r.status == "OK":
+            rows.append((r.file_name, details, *stamp, to_json(r)))
+            if len(rows) >= CACHE_BATCH:
+                # keep streaming without the cache when it can't be written
+                db = db if cache_put(db, rows) else None
+                rows = []
+        yield r
+    if db and rows:
+        cache_put(db, rows)
+
+
+def _init_worker(fs: pq.FileSystem = None):
+    """Pool initializer, keeps the file system in a global so it is pickled once per worker"""
+    global _FS
+    if fs is not None:
+        _FS = fs
+    # results hold no reference cycles, collections on huge to_dict() trees are wasted work
+    gc.disable()
+
+
+def _pool_get_metadata(params: tuple) -> Result:
+    """get_metadata on the worker's file system, for Pool.imap_unordered"""
+    return get_metadata(_FS, *params)
+
+
+def run_workers(
+    FS: pq.FileSystem, objs: list, details: int, workers: int, procs=False, mmap=False
+):
+    """Yields the metadata of each FileInfo in the order the workers finish them"""
+    # footer reads are I/O inside arrow which releases the GIL, so threads are enough
+    if procs:
+        global _FS
+        params = ((o.path, o.size, details, mmap) for o in objs)
+        if "fork" in multiprocessing.get_all_start_methods():
+            # forked children inherit _FS and the imported module, nothing to rebuild
+            _FS = FS
+            pool = multiprocessing.get_context("fork").Pool(
+                workers, initializer=_init_worker
+            )
+        else:
+            pool = Pool(workers, initializer=_init_worker, initargs=(FS,))
+        # about 4 batches per worker, enough to balance without a round trip per file
+        chunksize = max(1, len(objs) // (workers * 4))
+        with pool as p:
+            yield from p.imap_unordered(_pool_get_metadata, params, chunksize)
+    else:
+        todo = iter(objs)
+        pending = set()
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            while True:
+                # a bounded window, finished futures are dropped once yielded
+                for o in islice(todo, workers * 4 - len(pending)):
+                    pending.add(
+                        ex.submit(get_metadata, FS, o.path, o.size, details, mmap)
+                    )
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    yield f.result()
+
+
+def s3_store(bucket: str, opts: dict, region: str):
+    """Returns an obstore S3Store set up like the pyarrow S3 file system with the given options"""
+    unmapped = [k for k in ("role_arn", "tls_ca_file_path") if opts.get(k)]
+    if (opts.get("proxy_options") or {}).get("host"):
+        unmapped.append("proxy_options")
+    if unmapped:
+        # better to refuse than to quietly talk to aws with other credentials
+        logger.error(f"--obstore cannot use the S3 options {', '.join(unmapped)}")
+        raise (ValueError)
+
+    config = {"region": opts.get("region") or region}
+    keys = {
+        "access_key": "access_key_id",
+        "secret_key": "secret_access_key",
+        "session_token": "session_token",
+    }
+    config.update({new: opts[old] for old, new in keys.items() if opts.get(old)})
+    if opts.get("anonymous"):
+        config["skip_signature"] = True
+
+    scheme = opts.get("scheme") or "https"
+    endpoint = opts.get("endpoint_override")
+    if endpoint:
+        config["endpoint"] = endpoint if "://" in endpoint else f"{scheme}://{endpoint}"
+    if scheme == "http" or config.get("endpoint", "").startswith("http://"):
+        return S3Store(bucket, client_options={"allow_http": True}, **config)
+    return S3Store(bucket, **config)
+
+
+def open_store(fs: FS.FileSystem, path: str):
+    """Returns an obstore store for the bucket holding path and the prefix to strip from paths"""
+    if obstore is None:
+        logger.error("--obstore needs the obstore package installed")
+        raise (ImportError)
+    bucket = path.split("/", 1)[0]
+    # the options the pyarrow file system was built with, as used for pickling it
+    opts = fs.__reduce__()[1][0] if fs.type_name in ("s3", "gcs") else {}
+    if fs.type_name == "s3":
+        return s3_store(bucket, opts, fs.region), bucket + "/"
+    if fs.type_name == "gcs":
+        options = ("anonymous", "access_token", "target_service_account")
+        unmapped = [k for k in options + ("endpoint_override",) if opts.get(k)]
+        if unmapped:
+            logger.error(f"--obstore cannot use the GCS options {', '.join(unmapped)}")
+            raise (ValueError)
+        return GCSStore(bucket), bucket + "/"
+    if fs.type_name == "local":
+        return LocalStore(), "/"
+    logger.error(f"obstore does not support {fs.type_name} file systems")
+    raise (ValueError)
+
+
+def run_async(FS: pq.FileSystem, objs: list, details: int, inflight=MAX_INFLIGHT):
+    """Yields the metadata of each FileInfo as its requests complete, keeping inflight going"""
+    if not objs:
+        return
+    store, prefix = open_store(FS, objs[0].path)
+    todo = iter(objs)
+    pending = set()
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            # top up to the limit rather than creating a task per file up front
+            for o in islice(todo, inflight - len(pending)):
+                key = o.path[len(prefix) :]
+                coro = get_metadata_async(store, key, o.path, o.size, details)
+                pending.add(loop.create_task(coro))
+            if not pending:
+                break
+            done, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            )
+            for t in done:
+                yield t.result()
+    finally:
+        loop.close()
+
+
+def dedup_schemas(results, schemas: dict):
+    """Yields results with their schema swapped for a schema_id, collecting the schemas by id"""
+    for r in results:
+        if r.meta_data and "schema" in r.meta_data:
+            schema = r.meta_data.pop("schema")
+            # partitions of one table share a schema, a content hash is stable across runs
+            schema_id = hashlib.blake2b(to_json(schema), digest_size=8).hexdigest()
+            schemas.setdefault(schema_id, schema)
+            r.meta_data["schema_id"] = schema_id
+        yield r
+
+
+def _write_array(results, out, pad: bytes):
+    """Writes results as an indented JSON array, each line indented by pad"""
+    sep = b"\n" + pad
+    out.write(b"[")
+    for r in results:
+        out.write(sep + to_json(r, indent=True).replace(b"\n", b"\n" + pad))
+        sep = b",\n" + pad
+    out.write(b"]" if sep == b"\n" + pad else b"\n" + pad[:-2] + b"]")
+
+
+def write_results(results, lines=False, out=sys.stdout.buffer, schemas=None):
+    """Writes results as they arrive, either as a JSON array or as one JSON object per line
+
+    With schemas the results are listed under "files", followed by the schemas once
+    all results are written, as schemas are collected along the way
+    """
+    if lines:
+        for r in results:
+            out.write(to_json(r) + b"\n")
+        if schemas is not None:
+            out.write(to_json({"schemas": schemas}) + b"\n")
+        return
+
+    # same layout as an indented dump of the whole thing without holding it
+    if schemas is None:
+        _write_array(results, out, b"  ")
+        out.write(b"\n")
+        return
+    out.write(b'{\n  "files": ')
+    _write_array(results, out, b"    ")
+    out.write(b',\n  "schemas": ')
+    out.write(to_json(schemas, indent=True).replace(b"\n", b"\n  ") + b"\n}\n")
+
+
+def write_status(results, out=sys.stdout.buffer):
+    """Writes a status|file_name|file_size line per result, flushing every 1024 rows"""
+    # plain bytes formatting, no JSON needed to say whether a file is readable
+    for i, r in enumerate(results, 1):
+        name = r.file_name.encode()
+        out.write(b"%s|%s|%d\n" % (r.status.encode(), name, r.file_size))
+        if i % 1024 == 0:
+            out.flush()
+    out.flush()
 
 
 def main(args):
     logger.setLevel(args.log)
-    FS, objs = get_filelist(args.path, pattern=args.inc, recurse=args.recurse)
+    pool = int(args.pool or 8)
+    # checking only needs the footer to parse, nothing to extract
+    details = 0 if args.check else int(args.details)
+    # a check has to open every file, the sidecar would vouch for files unread
+    sidecar = args.use_metadata_sidecar and not args.check
+    if args.use_metadata_sidecar and args.check:
+        logger.warning("--use-metadata-sidecar ignored with --check")
+
+    FS, objs, done = get_filelist(
+        args.path,
+        pattern=args.inc,
+        recurse=args.recurse,
+        details=details,
+        sidecar=sidecar,
+    )
 
-    pool = int(args.pool)
-    details = int(args.details)
+    stamps = {o.path: cache_stamp(o) for o in objs}
+    db = None if args.no_cache else open_cache()
+    cached = cache_get(db, stamps, details) if db else set()
+    todo = [o for o in objs if o.path not in cached]
+    logger.debug(f"Found {len(objs) - len(todo)} of {len(objs)} objects in cache")
 
     workers = pool if pool > 1 else (multiprocessing.cpu_count() * 2 - 1)
     logger.debug(f"Number of workers set to : {workers}")
-    params = zip([FS] * len(objs), [o.path for o in objs], [details] * len(objs))
 
-    with Pool(workers) as p:
-        results = p.starmap(get_metadata, params)
-        print(json.dumps(results, indent=4, sort_keys=True))
+    mmap = args.mmap and FS.type_name == "local"
+    if args.mmap and not mmap:
+        logger.warning(f"--mmap ignored for {FS.type_name} file system")
+
+    if args.obstore:
+        flags = {"--procs": args.procs, "--mmap": args.mmap, "--pool": args.pool}
+        ignored = [flag for flag, given in flags.items() if given]
+        if ignored:
+            logger.warning(f"{', '.join(ignored)} ignored with --obstore")
+        fresh = run_async(FS, todo, details)
+    else:
+        fresh = run_workers(FS, todo, details, workers, procs=args.procs, mmap=mmap)
+    if db:
+        fresh = cache_through(db, fresh, stamps, details)
+    sizes = {o.path: o.size or 0 for o in objs}
+    hits = cache_hits(db, cached, details, sizes) if cached else ()
+    # known without opening the files, not worth caching either
+    results = chain(done, hits, fresh)
+
+    schemas = None
+    if args.check:
+        write_status(results)
+    elif args.dedup and details != 1:
+        logger.warning("--dedup only applies to --details=1")
+    elif args.dedup:
+        schemas = {}
+        results = dedup_schemas(results, schemas)
+    if not args.check:
+        write_results(results, lines=args.lines, schemas=schemas)
+    if db:
+        db.close()
 
 
 if __name__ == "__main__":